@@ -5,6 +5,21 @@
 STORAGE = 'LOCAL'
 # directory to store files uploaded in local file system
 UPLOAD_DIR = '/tmp/curl2share'
+# list of directories (eg: one per disk) to spread uploaded files across.
+# Files are placed by consistent hashing on their random uri.
+# Empty means only UPLOAD_DIR is used.
+UPLOAD_DIRS = []
+# number of virtual nodes of each upload dir on the hash ring
+UPLOAD_DIR_VNODES = 100
+# size (KB) of chunks to write uploaded files to disk
+WRITE_BUFFER_SIZE = 512
+# preallocate disk space of uploaded stream from its Content-Length
+WRITE_PREALLOCATE = True
+# sync uploaded files to disk before responding: 'none', 'fsync' or 'fdatasync'
+WRITE_FSYNC = 'none'
+# hint kernel to drop uploaded files from page cache once synced (True or False).
+# Only applies with WRITE_FSYNC, dirty pages are not dropped.
+WRITE_FADVISE = False
 # s3 bucket to store files uploaded
 AWS_BUCKET = 'curl2share'
 # length of uri in random format. Default '6'
@@ -21,5 +36,57 @@ REDIS = True
 REDIS_HOST = 'localhost'
 # Port of redis. Default 6379
 REDIS_PORT = 6379
+# Prefix of redis keys
+REDIS_PREFIX = 'c2s:'
+# Number of redis hashes file info is spread across. Keep files per hash
+# under hash-max-listpack-entries (128 by default) so redis stores them in
+# its compact encoding. Eg: 65536 for up to ~8 millions files.
+REDIS_BUCKETS = 65536
+# Files with uri longer than this (in bytes) are stored by hash of uri.
+# Keep it and packed info (up to ~25 bytes, more for uncommon content
+# types) under hash-max-listpack-value (64 by default), otherwise the hash
+# is converted to redis regular encoding.
+REDIS_MAX_FIELD = 64
+# Seconds file info is kept in redis since last read or write.
+# 0 means never expire.
+REDIS_TTL = 60 * 60 * 24 * 7
+# maximum number of paths in a request to /api/info
+BULK_MAX_PATHS = 500
+# maximum concurrent requests to S3 to get info of files not in redis
+BULK_S3_WORKERS = 16
+# Rate limit of /api/info, each request may send BULK_MAX_PATHS requests to S3
+BULK_RATE_LIMIT = '100/hour;10/minute'
 # Rate limit. Syntax should follow goo.gl/FWxPrF
 RATE_LIMIT = '200/hour;15/minute'
+# Admission control of uploads (True or False).
+# Uploads over the limits below are rejected with 503 and Retry-After
+# before their body is read.
+ADMISSION = True
+# maximum concurrent uploads and in-flight size (MB) of a worker.
+# Only matters with threaded or async workers, a sync worker handles
+# one upload at a time.
+ADMISSION_WORKER_UPLOADS = 8
+ADMISSION_WORKER_SIZE = 100
+# maximum concurrent uploads and in-flight size (MB) of all workers on a node.
+# Set them below number of workers and workers * MAX_FILE_SIZE, otherwise
+# they never apply. Size must be at least MAX_FILE_SIZE.
+ADMISSION_NODE_UPLOADS = 8
+ADMISSION_NODE_SIZE = 40
+# file to share admission state between workers on a node
+ADMISSION_STATE_FILE = '/tmp/curl2share.admission'
+# upload throughput (MB/s) assumed before any upload finished
+ADMISSION_DEFAULT_RATE = 10
+# maximum value of Retry-After in seconds
+ADMISSION_MAX_RETRY_AFTER = 60
+# Profile requests on demand (True or False).
+# Profile stats are saved to PROFILE_DIR, read them with python -m pstats.
+PROFILE = False
+# Profile requests having header PROFILE_HEADER equal to PROFILE_TOKEN.
+# Empty token disables profiling by header.
+PROFILE_HEADER = 'X-Profile'
+PROFILE_TOKEN = ''
+# Profile 1 in PROFILE_SAMPLE requests. 0 disables sampling.
+PROFILE_SAMPLE = 0
+# directory to save profile stats and number of latest stats to keep
+PROFILE_DIR = '/tmp/curl2share-profiles'
+PROFILE_KEEP = 50
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, division
+import os
+import json
+import math
+import time
+import logging
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    # no shared node state without fcntl (Eg: Windows)
+    fcntl = None
+
+import config
+
+
+class Admission(object):
+    '''
+    Track concurrent uploads and in-flight bytes of this worker and
+    of all workers on this node, and refuse uploads over the limits.
+    Node state is shared through a json file locked with flock, one entry
+    per worker pid. Entries of dead workers are dropped.
+    '''
+    def __init__(self):
+        self.logger = logging.getLogger(__name__ + '.' + self.__class__.__name__)
+        self.enabled = getattr(config, 'ADMISSION', False)
+        mb = 1024 * 1024
+        self.worker_uploads = getattr(config, 'ADMISSION_WORKER_UPLOADS', 8)
+        self.worker_bytes = getattr(config, 'ADMISSION_WORKER_SIZE', 100) * mb
+        self.node_uploads = getattr(config, 'ADMISSION_NODE_UPLOADS', 8)
+        self.node_bytes = getattr(config, 'ADMISSION_NODE_SIZE', 40) * mb
+        self.state_file = getattr(config, 'ADMISSION_STATE_FILE',
+                                  '/tmp/curl2share.admission') if fcntl else None
+        self.max_retry = getattr(config, 'ADMISSION_MAX_RETRY_AFTER', 60)
+        self.lock = threading.Lock()
+        self.uploads = 0
+        self.bytes = 0
+        self.rejected = 0
+        # moving averages of upload throughput (bytes/s) and duration (s)
+        self.rate = getattr(config, 'ADMISSION_DEFAULT_RATE', 10) * mb
+        self.duration = 1.0
+
+    def _update_node(self, uploads, size):
+        '''
+        Add uploads and size to this worker in node state.
+        With uploads > 0, nothing is changed if node limits are exceeded.
+        Return node totals (uploads, bytes) before the change and
+        whether the change was applied.
+        '''
+        pid = str(os.getpid())
+        fd = os.open(self.state_file, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            with os.fdopen(os.dup(fd), 'r+') as f:
+                try:
+                    state = json.load(f)
+                except ValueError:
+                    state = dict()
+                for wpid in list(state):
+                    if wpid != pid and not self._alive(int(wpid)):
+                        del state[wpid]
+                total_uploads = sum(w[0] for w in state.values())
+                total_bytes = sum(w[1] for w in state.values())
+                if uploads > 0 and \
+                        (total_uploads + uploads > self.node_uploads or
+                         total_bytes + size > self.node_bytes):
+                    return total_uploads, total_bytes, False
+                own = state.get(pid, [0, 0])
+                own = [max(0, own[0] + uploads), max(0, own[1] + size)]
+                if own[0]:
+                    state[pid] = own
+                else:
+                    state.pop(pid, None)
+                f.seek(0)
+                f.truncate()
+                json.dump(state, f)
+                return total_uploads, total_bytes, True
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+    @staticmethod
+    def _alive(pid):
+        ''' Return True if process pid is running '''
+        try:
+            os.kill(pid, 0)
+        except OSError as e:
+            return e.errno == 1  # EPERM: running, owned by another user
+        return True
+
+    def retry_after(self, uploads, inflight, max_uploads, max_bytes, size):
+        '''
+        Estimate seconds until an upload of size can be admitted:
+        time to drain the bytes over the limit at average throughput,
+        or an average upload duration if there are too many uploads.
+        '''
+        wait = max(0, inflight + size - max_bytes) / self.rate
+        if uploads >= max_uploads:
+            wait = max(wait, self.duration)
+        return int(min(self.max_retry, max(1, math.ceil(wait))))
+
+    def too_large(self, size):
+        ''' Return True if an upload of size can never be admitted '''
+        return self.enabled and bool(size) and \
+            (size > self.worker_bytes or size > self.node_bytes)
+
+    def acquire(self, size):
+        '''
+        Try to admit an upload of size bytes.
+        Return None if admitted, otherwise seconds to retry after.
+        '''
+        if not self.enabled:
+            return None
+        size = size or 0
+        with self.lock:
+            if self.uploads + 1 > self.worker_uploads or \
+                    self.bytes + size > self.worker_bytes:
+                self.rejected += 1
+                return self.retry_after(self.uploads, self.bytes,
+                                        self.worker_uploads, self.worker_bytes, size)
+            if self.state_file:
+                try:
+                    uploads, inflight, ok = self._update_node(1, size)
+                except (IOError, OSError):
+                    self.logger.warning('Unable to update node admission state', exc_info=True)
+                    ok = True
+                if not ok:
+                    self.rejected += 1
+                    return self.retry_after(uploads, inflight,
+                                            self.node_uploads, self.node_bytes, size)
+            self.uploads += 1
+            self.bytes += size
+        return None
+
+    def release(self, size, started=None):
+        '''
+        Release an admitted upload of size bytes.
+        started: time upload was admitted, to update average throughput
+        '''
+        if not self.enabled:
+            return
+        size = size or 0
+        with self.lock:
+            self.uploads -= 1
+            self.bytes -= size
+            if started:
+                elapsed = max(time.time() - started, 0.001)
+                self.duration = 0.8 * self.duration + 0.2 * elapsed
+                if size:
+                    self.rate = 0.8 * self.rate + 0.2 * size / elapsed
+            if self.state_file:
+                try:
+                    self._update_node(-1, -size)
+                except (IOError, OSError):
+                    self.logger.warning('Unable to update node admission state', exc_info=True)
+
+    def state(self):
+        ''' Return admission state as a dict for monitoring '''
+        node_uploads = node_bytes = None
+        if self.enabled and self.state_file:
+            try:
+                node_uploads, node_bytes, _ = self._update_node(0, 0)
+            except (IOError, OSError):
+                self.logger.warning('Unable to read node admission state', exc_info=True)
+        return dict(Enabled=self.enabled,
+                    WorkerUploads=self.uploads,
+                    WorkerBytes=self.bytes,
+                    WorkerMaxUploads=self.worker_uploads,
+                    WorkerMaxBytes=self.worker_bytes,
+                    NodeUploads=node_uploads,
+                    NodeBytes=node_bytes,
+                    NodeMaxUploads=self.node_uploads,
+                    NodeMaxBytes=self.node_bytes,
+                    Rejected=self.rejected,
+                    AvgRate=int(self.rate),
+                    AvgDuration=round(self.duration, 3)
+                    )
@@ -3,17 +3,25 @@
 
 from __future__ import absolute_import, division
 import os
+import time
 import logging
 
 from flask import Flask, request, make_response, abort, \
-    url_for, render_template, jsonify
+    url_for, render_template, jsonify, g
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 
 from werkzeug.utils import secure_filename
 
+try:
+    string_types = basestring  # python2
+except NameError:
+    string_types = str  # python3
+
 import config
 from curl2share import utils
+from curl2share.admission import Admission
+from curl2share.profiler import Profiler
 
 if config.STORAGE == 'S3':
     from curl2share.storage import S3, Redis
@@ -30,6 +38,10 @@ logger = logging.getLogger(__name__)
 
 limiter = Limiter(app, key_func=get_remote_address)
 
+admission = Admission()
+
+profiler = Profiler(app)
+
 
 @app.errorhandler(400)
 def bad_request(err):
@@ -90,6 +102,31 @@ def index():
 @app.route('/<string:file_name>', methods=['POST', 'PUT'])
 @limiter.limit(config.RATE_LIMIT)
 def upload(file_name):
+    ''' Admit upload before reading its body '''
+    size = request.content_length
+    # uploads which can never be admitted must not be told to retry
+    if size and (size > app.config['MAX_CONTENT_LENGTH'] or
+                 admission.too_large(size)):
+        abort(413)
+    retry = admission.acquire(size)
+    if retry:
+        logger.warning('Upload {} {} of {} bytes rejected, retry after {}s'.format(
+            request.method, request.path, size, retry))
+        resp = make_response('Server busy. Retry after {} seconds'.format(retry), 503)
+        resp.headers['Retry-After'] = str(retry)
+        return resp
+    started = time.time()
+    admitted = None
+    try:
+        resp = _upload(file_name)
+        # only successful uploads count to average throughput
+        admitted = started
+        return resp
+    finally:
+        admission.release(size, admitted)
+
+
+def _upload(file_name):
     ''' Write data '''
     sdir = utils.rand()
     ct = request.headers.get('Content-Type')
@@ -119,10 +156,11 @@ def upload(file_name):
         logger.error('Invalid request header: \n{}'.format(request.headers))
         abort(400)
 
+    g.file_size = filesize
     dest = '/'.join([sdir, fname])
 
     if config.STORAGE == 'LOCAL':
-        fs.write(dest, req)
+        fs.write(dest, req, filesize)
 
     if config.STORAGE == 'S3':
         partsize = 1024 * 1024 * 5
@@ -153,6 +191,67 @@ def download(path):
     return resp
 
 
+@app.route('/api/info', methods=['POST'])
+@limiter.limit(config.BULK_RATE_LIMIT)
+def bulk_info():
+    '''
+    Return size, type and download url of many files as json.
+    Request body: {"paths": ["Ab3dE6/file.txt", ...]}
+    '''
+    body = request.get_json(silent=True) or {}
+    paths = body.get('paths')
+    if not isinstance(paths, list) or \
+            not all(isinstance(p, string_types) for p in paths):
+        abort(400)
+    if len(paths) > config.BULK_MAX_PATHS:
+        logger.error('Request info of {} files, limit {}.'.format(
+            len(paths), config.BULK_MAX_PATHS))
+        abort(400)
+    unique = list(set(paths))
+
+    infos = dict()
+    if config.STORAGE == 'S3':
+        if config.REDIS:
+            # one round trip to redis for all paths, then
+            # get info of missing ones from S3 concurrently and
+            # insert back to redis for future use
+            redis = Redis()
+            infos = redis.get_many(unique)
+            missing = [p for p in unique if not infos.get(p)]
+            found = s3.info_many(missing, config.BULK_S3_WORKERS)
+            infos.update(found)
+            redis.load((p, i) for p, i in found.items() if i)
+        else:
+            infos = s3.info_many(unique, config.BULK_S3_WORKERS)
+        for path in unique:
+            if infos.get(path):
+                infos[path]['url'] = s3.url(path)
+
+    if config.STORAGE == 'LOCAL':
+        for path in unique:
+            # paths of request body are not normalized like urls
+            if os.path.isabs(path) or '..' in path.split('/'):
+                continue
+            dst = fs.path(path)
+            if os.path.isfile(dst):
+                infos[path] = {'content_length': os.path.getsize(dst),
+                               'content_type': fs.mime(dst),
+                               'url': url_for('download', path=path, _external=True)}
+
+    files = []
+    for path in paths:
+        info = infos.get(path)
+        if info:
+            files.append(dict(Path=path,
+                              Size=int(info['content_length']),
+                              Type=info['content_type'],
+                              Url=info['url']))
+        else:
+            files.append(dict(Path=path, Error='Not Found'))
+
+    return jsonify(Files=files)
+
+
 @app.route('/<path:path>', methods=['GET'])
 def preview(path):
     ''' Render a preview page based on file information '''
@@ -176,13 +275,14 @@ def preview(path):
 
     if config.STORAGE == 'LOCAL':
         dl_url = url_for('download', path=path, _external=True)
-        dst = os.path.join(config.UPLOAD_DIR, path)
+        dst = fs.path(path)
         if not os.path.isfile(dst):
             abort(404)
 
         filesize = os.path.getsize(dst)
         filetype = fs.mime(dst)
 
+    g.file_size = filesize
     return render_template('preview.html',
                            title=os.path.basename(path),
                            file_name=os.path.basename(path),
@@ -199,7 +299,7 @@ def healthcheck():
     redis_conn = ''
     redis_host = ''
     if config.STORAGE == 'LOCAL':
-        storage_writable = os.access(config.UPLOAD_DIR, os.W_OK)
+        storage_writable = fs.writable()
     elif config.STORAGE == 'S3':
         redis_enabled = config.REDIS
         if redis_enabled:
@@ -212,7 +312,8 @@ def healthcheck():
                    StorageConnectionOK=storage_writable,
                    RedisEnabled=redis_enabled,
                    RedisHost=redis_host,
-                   RedisConnectionOK=redis_conn
+                   RedisConnectionOK=redis_conn,
+                   Admission=admission.state()
                    )
 
     return resp
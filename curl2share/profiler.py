@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+import os
+import hmac
+import time
+import cProfile
+import logging
+import threading
+
+from flask import g, request
+
+import config
+
+
+class Profiler(object):
+    '''
+    Profile requests on demand and dump stats to PROFILE_DIR.
+    A request is profiled if PROFILE is enabled and either it has header
+    PROFILE_HEADER equal to PROFILE_TOKEN, or it is sampled (1 in
+    PROFILE_SAMPLE requests). Dumps are named after time, route and
+    file size, only latest PROFILE_KEEP dumps are kept.
+    Read a dump with: python -m pstats <file>
+    '''
+    def __init__(self, app):
+        self.logger = logging.getLogger(__name__ + '.' + self.__class__.__name__)
+        self.enabled = getattr(config, 'PROFILE', False)
+        self.header = getattr(config, 'PROFILE_HEADER', 'X-Profile')
+        self.token = getattr(config, 'PROFILE_TOKEN', '')
+        self.sample = getattr(config, 'PROFILE_SAMPLE', 0)
+        self.store_dir = getattr(config, 'PROFILE_DIR', '/tmp/curl2share-profiles')
+        self.keep = getattr(config, 'PROFILE_KEEP', 50)
+        self.count = 0
+        self.lock = threading.Lock()
+        if self.enabled:
+            if not os.path.isdir(self.store_dir):
+                os.makedirs(self.store_dir)
+            app.before_request(self.start)
+            app.after_request(self.stop)
+            app.teardown_request(self.teardown)
+
+    def wanted(self):
+        ''' Return True if current request should be profiled '''
+        token = request.headers.get(self.header)
+        if token and self.token and \
+                hmac.compare_digest(token.encode('utf-8'), self.token.encode('utf-8')):
+            return True
+        if self.sample > 0:
+            with self.lock:
+                self.count += 1
+                return self.count % self.sample == 0
+        return False
+
+    def start(self):
+        ''' Start profiling current request if wanted '''
+        if self.wanted():
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # another request is being profiled in this process
+                self.logger.warning('Unable to profile {}'.format(request.path), exc_info=True)
+                return
+            g.profile = profile
+
+    def stop(self, resp):
+        ''' Stop profiling current request and dump stats '''
+        profile = getattr(g, 'profile', None)
+        if profile is None:
+            return resp
+        profile.disable()
+        g.profile = None
+        size = getattr(g, 'file_size', None) or request.content_length or \
+            resp.content_length or 0
+        fname = '{:.6f}-{}-{}-{}-{}b.prof'.format(
+            time.time(), request.method, request.endpoint, resp.status_code, size)
+        try:
+            profile.dump_stats(os.path.join(self.store_dir, fname))
+            self.logger.info('Profile of {} {} saved to {}'.format(request.method,
+                                                                   request.path, fname))
+            self.cleanup()
+        except (IOError, OSError):
+            self.logger.warning('Unable to save profile of {}'.format(request.path), exc_info=True)
+        return resp
+
+    def teardown(self, err):
+        ''' Stop profiling if request ended with an unhandled error '''
+        profile = getattr(g, 'profile', None)
+        if profile is not None:
+            profile.disable()
+            g.profile = None
+
+    def cleanup(self):
+        ''' Remove oldest dumps to keep at most PROFILE_KEEP dumps '''
+        dumps = sorted(f for f in os.listdir(self.store_dir) if f.endswith('.prof'))
+        for fname in dumps[:max(0, len(dumps) - self.keep)]:
+            try:
+                os.remove(os.path.join(self.store_dir, fname))
+            except OSError:
+                pass
@@ -2,11 +2,22 @@
 # -*- coding: utf-8 -*-
 
 from __future__ import absolute_import
+import io
 import os
+import time
+import string
+import zlib
+import base64
+import shutil
+import bisect
+import hashlib
 import magic
 import logging
+import threading
+from multiprocessing.pool import ThreadPool
 
 from flask import abort, make_response, send_from_directory
+from werkzeug.exceptions import HTTPException
 import boto3 as boto
 import botocore
 import redis
@@ -159,12 +170,26 @@ class S3(object):
         path: object path to download
         '''
         if self.exists(path):
-            scheme = 'https://'
-            s3_url = '/'.join([self.bucket + '.' + 's3.amazonaws.com', path])
-            url = scheme + s3_url
+            url = self.url(path)
             self.logger.info('{} downloaded from S3'.format(path))
             return url
 
+    def url(self, path):
+        ''' Return download url of object without checking its existence '''
+        scheme = 'https://'
+        s3_url = '/'.join([self.bucket + '.' + 's3.amazonaws.com', path])
+        return scheme + s3_url
+
+    def list(self, prefix=''):
+        '''
+        Yield path of all objects in bucket
+        prefix: only list objects starting with prefix
+        '''
+        paginator = self.client.get_paginator('list_objects')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+            for obj in page.get('Contents', []):
+                yield obj['Key']
+
     def info(self, path):
         '''
         Get metadata of object and return as a dict
@@ -179,6 +204,95 @@ class S3(object):
             self.logger.info('Retrieved info of {} from S3.'.format(path))
             return _info
 
+    def info_many(self, paths, workers=16):
+        '''
+        Get metadata of many objects with concurrent requests.
+        Return a dict of path and its info, None if object not found.
+        paths: object paths to get metadata
+        workers: maximum concurrent requests
+        '''
+        def _info(path):
+            try:
+                return path, self.info(path)
+            except HTTPException:
+                return path, None
+            except Exception:
+                self.logger.warning('Unable to get info of {} from S3.'.format(path), exc_info=True)
+                return path, None
+
+        if not paths:
+            return dict()
+        pool = ThreadPool(min(workers, len(paths)))
+        try:
+            return dict(pool.map(_info, paths))
+        finally:
+            pool.close()
+            pool.join()
+
+
+class HashRing(object):
+    '''
+    Consistent hash ring to place keys on nodes.
+    Adding or removing a node only moves the keys owned by that node.
+    '''
+    def __init__(self, nodes, vnodes=100):
+        self.vnodes = vnodes
+        self.ring = dict()
+        self.keys = []
+        self.members = []
+        for node in nodes:
+            self.add(node)
+
+    @staticmethod
+    def _hash(key):
+        ''' Return position of key on the ring '''
+        return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:16], 16)
+
+    def add(self, node):
+        ''' Add node and its virtual nodes to the ring '''
+        if node in self.members:
+            return
+        self.members.append(node)
+        for i in range(self.vnodes):
+            h = self._hash('{}#{}'.format(node, i))
+            if h not in self.ring:
+                bisect.insort(self.keys, h)
+            self.ring[h] = node
+
+    def remove(self, node):
+        ''' Remove node and its virtual nodes from the ring '''
+        if node not in self.members:
+            return
+        self.members.remove(node)
+        for i in range(self.vnodes):
+            h = self._hash('{}#{}'.format(node, i))
+            if self.ring.get(h) == node:
+                del self.ring[h]
+                self.keys.remove(h)
+
+    def nodes(self, key):
+        '''
+        Return distinct nodes in ring order starting from owner of key.
+        First item is the node key is placed on.
+        '''
+        if not self.keys:
+            return []
+        found = []
+        total = len(self.members)
+        idx = bisect.bisect(self.keys, self._hash(key))
+        for i in range(len(self.keys)):
+            node = self.ring[self.keys[(idx + i) % len(self.keys)]]
+            if node not in found:
+                found.append(node)
+                if len(found) == total:
+                    break
+        return found
+
+    def get(self, key):
+        ''' Return node key is placed on '''
+        nodes = self.nodes(key)
+        return nodes[0] if nodes else None
+
 
 class FileSystem(object):
     '''
@@ -187,12 +301,95 @@ class FileSystem(object):
     def __init__(self):
         self.logger = logging.getLogger(__name__ + '.' + self.__class__.__name__)
         if config.STORAGE == 'LOCAL':
-            self.store_dir = config.UPLOAD_DIR
-        if not os.path.isdir(self.store_dir):
-            os.mkdir(self.store_dir)
-        if os.path.isdir(self.store_dir) and \
-                not os.access(self.store_dir, os.W_OK):
-            raise OSError('{} exists but not writable!'.format(self.store_dir))
+            self.store_dirs = list(getattr(config, 'UPLOAD_DIRS', None) or
+                                   [config.UPLOAD_DIR])
+        for store_dir in self.store_dirs:
+            if not os.path.isdir(store_dir):
+                os.mkdir(store_dir)
+            if os.path.isdir(store_dir) and \
+                    not os.access(store_dir, os.W_OK):
+                raise OSError('{} exists but not writable!'.format(store_dir))
+        self.ring = HashRing(self.store_dirs,
+                             getattr(config, 'UPLOAD_DIR_VNODES', 100))
+        self.buf_size = getattr(config, 'WRITE_BUFFER_SIZE', 512) * 1024
+        self.preallocate = getattr(config, 'WRITE_PREALLOCATE', True)
+        self.fsync = getattr(config, 'WRITE_FSYNC', 'none')
+        self.fadvise = getattr(config, 'WRITE_FADVISE', False)
+        self.local = threading.local()
+        if self.fadvise and self.fsync == 'none':
+            self.logger.warning('WRITE_FADVISE has no effect without WRITE_FSYNC')
+
+    @staticmethod
+    def _key(path):
+        ''' Return placement key of path, which is its random dir '''
+        return path.lstrip('/').split('/', 1)[0]
+
+    def volume(self, path):
+        '''
+        Return upload dir file of path should be placed on
+        path: file path (uri)
+        '''
+        return self.ring.get(self._key(path))
+
+    def locate(self, path):
+        '''
+        Return upload dir which has file of path.
+        Files not rebalanced yet after adding an upload dir are still
+        found on next dirs of the ring. Fall back to the placement dir.
+        path: file path (uri)
+        '''
+        for store_dir in self.ring.nodes(self._key(path)):
+            if os.path.isfile(os.path.join(store_dir, path)):
+                return store_dir
+        return self.volume(path)
+
+    def path(self, path):
+        '''
+        Return absolute path on disk of path
+        path: file path (uri)
+        '''
+        return os.path.join(self.locate(path), path)
+
+    def writable(self):
+        ''' Return True if all upload dirs are writable '''
+        return all(os.access(d, os.W_OK) for d in self.store_dirs)
+
+    @staticmethod
+    def is_upload_dir(name):
+        ''' Return True if name has format of utils.rand() '''
+        return len(name) == config.RAND_DIR_LENGTH and \
+            all(c in string.ascii_letters + string.digits for c in name)
+
+    def rebalance(self):
+        '''
+        Move files which are not on their placement dir.
+        Only dirs owned by a new upload dir are moved, other entries
+        of upload dirs (Eg: lost+found) are left untouched.
+        A dir is copied to a temporary name on its placement dir, then
+        renamed, so a partially copied file is never served.
+        Return number of moved dirs.
+        '''
+        moved = 0
+        for store_dir in self.store_dirs:
+            for sdir in os.listdir(store_dir):
+                src = os.path.join(store_dir, sdir)
+                dst_dir = self.volume(sdir)
+                if dst_dir == store_dir or not self.is_upload_dir(sdir) or \
+                        not os.path.isdir(src):
+                    continue
+                dst = os.path.join(dst_dir, sdir)
+                if os.path.exists(dst):
+                    self.logger.warning('{} already exists, skip moving {}'.format(dst, src))
+                    continue
+                tmp = os.path.join(dst_dir, '.{}.tmp'.format(sdir))
+                if os.path.exists(tmp):
+                    shutil.rmtree(tmp)
+                shutil.copytree(src, tmp)
+                os.rename(tmp, dst)
+                shutil.rmtree(src)
+                self.logger.info('Moved {} to {}'.format(src, dst))
+                moved += 1
+        return moved
 
     @staticmethod
     def mime(dest):
@@ -205,37 +402,151 @@ class FileSystem(object):
     def get(self, path):
         ''' Return file '''
         self.logger.info('{} downloaded from disk.'.format(path))
-        return make_response(send_from_directory(self.store_dir, path))
+        return make_response(send_from_directory(self.locate(path), path))
 
-    def write(self, path, req):
+    def write(self, path, req, size=None):
         '''
         Write file content to disk
         path: file path (uri) to write
         req: request object contains file data.
+        size: expected file size, to preallocate disk space
         '''
-        dst = os.path.join(self.store_dir, path)
+        dst = os.path.join(self.volume(path), path)
+        os.mkdir(os.path.split(dst)[0])
         try:
-            os.mkdir(os.path.split(dst)[0])
-            # assume file sent by multipart/form-data
-            # try to use method save() of file object
-            req.save(dst)
-            self.logger.info('{} saved to disk'.format(dst))
-            return True
-        except AttributeError:
-            with open(dst, 'wb') as f:
-                # limit chunk size to read at a time
-                buf_max = 1024 * 500
-                buf = 1024 * 16
-                while True:
-                    chunk = req.read(buf)
-                    if not chunk:
-                        break
-                    f.write(chunk)
-                    # double chunk size in each iteration
-                    if buf < buf_max:
-                        buf = buf * 2
-            self.logger.info('{} saved to disk.'.format(dst))
-            return True
+            if hasattr(req, 'save'):
+                # file sent by multipart/form-data
+                self.write_form(dst, req, size)
+            else:
+                self.write_into(dst, req, size)
+        except Exception:
+            self.logger.error('Failed to save {}'.format(dst), exc_info=True)
+            shutil.rmtree(os.path.split(dst)[0], ignore_errors=True)
+            raise
+        self.logger.info('{} saved to disk.'.format(dst))
+        return True
+
+    def _buffer(self):
+        ''' Return write buffer of current thread, reused across writes '''
+        buf = getattr(self.local, 'buf', None)
+        if buf is None or len(buf) != self.buf_size:
+            buf = self.local.buf = bytearray(self.buf_size)
+        return buf
+
+    def _finish(self, f):
+        ''' Apply fsync policy and page cache hint to written file '''
+        f.flush()
+        fd = f.fileno()
+        if self.fsync == 'fsync':
+            os.fsync(fd)
+        elif self.fsync == 'fdatasync':
+            getattr(os, 'fdatasync', os.fsync)(fd)
+        # dirty pages are not dropped, so only hint after they are synced
+        if self.fadvise and self.fsync != 'none' and hasattr(os, 'posix_fadvise'):
+            # written file is not read back by this app, drop it from cache
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+
+    def _write(self, dst, size, copy):
+        '''
+        Write dst with copy(f), which returns number of bytes written.
+        Disk space is preallocated from size, then fsync policy and
+        page cache hint are applied. dst is removed if writing fails,
+        Eg: client disconnected.
+        Return number of bytes written.
+        '''
+        try:
+            # unbuffered, so chunks are written without copy
+            with io.open(dst, 'wb', buffering=0) as f:
+                if size and self.preallocate and hasattr(os, 'posix_fallocate'):
+                    try:
+                        os.posix_fallocate(f.fileno(), 0, size)
+                    except OSError:
+                        # Eg: file system doesn't support it
+                        self.logger.debug('Unable to preallocate {}'.format(dst), exc_info=True)
+                written = copy(f)
+                if size and written < size:
+                    # drop space preallocated but not written
+                    f.truncate(written)
+                self._finish(f)
+            return written
+        except Exception:
+            if os.path.exists(dst):
+                os.remove(dst)
+            raise
+
+    def write_chunks(self, dst, req):
+        '''
+        Write stream to dst with chunks of growing size.
+        This was the write path before write_into(), kept to benchmark it.
+        Return number of bytes written.
+        '''
+        written = 0
+        with open(dst, 'wb') as f:
+            # limit chunk size to read at a time
+            buf_max = 1024 * 500
+            buf = 1024 * 16
+            while True:
+                chunk = req.read(buf)
+                if not chunk:
+                    break
+                f.write(chunk)
+                written += len(chunk)
+                # double chunk size in each iteration
+                if buf < buf_max:
+                    buf = buf * 2
+            self._finish(f)
+        return written
+
+    def write_into(self, dst, req, size=None):
+        '''
+        Write stream to dst.
+        Streams with readinto() are read into a reused buffer, without
+        allocating a bytes object per chunk. Others (Eg: werkzeug 0.11
+        LimitedStream) are read by chunks of buffer size, written as is.
+        Return number of bytes written.
+        size: expected file size, to preallocate disk space
+        '''
+        readinto = getattr(req, 'readinto', None)
+
+        def copy_into(f):
+            view = memoryview(self._buffer())
+            written = 0
+            while True:
+                n = readinto(view)
+                if not n:
+                    break
+                chunk = view[:n]
+                while chunk:
+                    chunk = chunk[f.write(chunk):]
+                written += n
+            return written
+
+        def copy(f):
+            written = 0
+            while True:
+                data = req.read(self.buf_size)
+                if not data:
+                    break
+                chunk = memoryview(data)
+                while chunk:
+                    chunk = chunk[f.write(chunk):]
+                written += len(data)
+            return written
+
+        return self._write(dst, size, copy_into if readinto else copy)
+
+    def write_form(self, dst, req, size=None):
+        '''
+        Write file sent by multipart/form-data to dst.
+        Return number of bytes written.
+        req: file object with method save()
+        size: file size, to preallocate disk space
+        '''
+        def copy(f):
+            req.save(f, self.buf_size)
+            return f.tell()
+
+        return self._write(dst, size, copy)
 
 
 class Redis(object):
@@ -244,7 +555,57 @@ class Redis(object):
         REMEMBER: Redis is a caching layer.
             That means if something went wrong with it,
             the app should still run by accessing to S3
+
+        Info of files is packed as "expiry|content_length|content_type"
+        in fields of REDIS_BUCKETS hashes. Common content types are
+        stored as their index in MIME_TYPES, and keys longer than
+        REDIS_MAX_FIELD bytes are stored as their hash, so fields and
+        values stay under hash-max-listpack-value and each hash is kept
+        in redis compact encoding. Uncommon long content types can
+        still exceed it. Hashes expire after REDIS_TTL without writes,
+        expired fields are removed on read or by prune().
     '''
+    # Only append to this list: info in redis refers to indexes of it.
+    MIME_TYPES = (
+        'application/octet-stream',
+        'text/plain',
+        'text/html',
+        'text/csv',
+        'text/xml',
+        'text/x-c',
+        'text/x-python',
+        'text/x-shellscript',
+        'image/png',
+        'image/jpeg',
+        'image/gif',
+        'image/webp',
+        'image/svg+xml',
+        'video/mp4',
+        'video/webm',
+        'video/quicktime',
+        'audio/mpeg',
+        'audio/x-wav',
+        'application/pdf',
+        'application/json',
+        'application/xml',
+        'application/zip',
+        'application/gzip',
+        'application/x-gzip',
+        'application/x-bzip2',
+        'application/x-xz',
+        'application/x-tar',
+        'application/x-7z-compressed',
+        'application/x-executable',
+        'application/x-sharedlib',
+        'application/x-dosexec',
+        'application/msword',
+        'application/vnd.ms-excel',
+        'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+        'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+        'application/vnd.openxmlformats-officedocument.presentationml.presentation',
+        'inode/x-empty',
+    )
+
     def __init__(self):
         try:
             self.host = config.REDIS_HOST
@@ -252,6 +613,11 @@ class Redis(object):
         except AttributeError:
             self.host = 'localhost'
             self.port = 6379
+        self.prefix = getattr(config, 'REDIS_PREFIX', 'c2s:')
+        self.buckets = getattr(config, 'REDIS_BUCKETS', 65536)
+        self.ttl = getattr(config, 'REDIS_TTL', 0)
+        self.max_field = getattr(config, 'REDIS_MAX_FIELD', 64)
+        self.mime_index = dict((t, i) for i, t in enumerate(self.MIME_TYPES))
         self.rd = redis.StrictRedis(host=self.host,
                                     port=self.port,
                                     decode_responses=True)
@@ -266,23 +632,122 @@ class Redis(object):
         except:
             return False
 
+    def field(self, key):
+        '''
+        Return name of hash field storing info of key.
+        Keys longer than REDIS_MAX_FIELD bytes are hashed,
+        hashed names start with "#" which is never in a uri.
+        '''
+        if len(key.encode('utf-8')) <= self.max_field:
+            return key
+        digest = base64.urlsafe_b64encode(hashlib.md5(key.encode('utf-8')).digest())
+        return '#' + digest.decode('ascii').rstrip('=')
+
+    def bucket(self, key):
+        ''' Return name of redis hash storing info of key '''
+        crc = zlib.crc32(self.field(key).encode('utf-8')) & 0xffffffff
+        return '{}{}'.format(self.prefix, crc % self.buckets)
+
+    def pack(self, info, now=None):
+        ''' Return info as a string with its expiry time '''
+        expiry = int(now or time.time()) + self.ttl if self.ttl else 0
+        ctype = self.mime_index.get(info['content_type'], info['content_type'])
+        return '{}|{}|{}'.format(expiry, info['content_length'], ctype)
+
+    def unpack(self, value):
+        ''' Return expiry time and info of a packed string '''
+        expiry, length, ctype = value.split('|', 2)
+        if ctype.isdigit():
+            try:
+                ctype = self.MIME_TYPES[int(ctype)]
+            except IndexError:
+                raise ValueError('Unknown content type index {}'.format(ctype))
+        return int(expiry), {'content_length': length, 'content_type': ctype}
+
+    def _write(self, pipe, key, info, now=None):
+        ''' Queue insertion of info of key to pipeline '''
+        bucket = self.bucket(key)
+        pipe.hset(bucket, self.field(key), self.pack(info, now))
+        if self.ttl:
+            pipe.expire(bucket, self.ttl)
+
+    def _read(self, key, value, now):
+        '''
+        Return info of key from packed value, or an empty dict if
+        there is no value or it expired.
+        Also return whether info has to be removed or refreshed.
+        '''
+        if not value:
+            return dict(), None
+        try:
+            expiry, info = self.unpack(value)
+        except ValueError:
+            self.logger.warning('Invalid info of {} in redis: {}'.format(key, value))
+            return dict(), 'delete'
+        if not expiry:
+            return info, None
+        if expiry <= now:
+            self.logger.info('Info of {} in redis expired.'.format(key))
+            return dict(), 'delete'
+        # refresh on read, at most once per half of ttl
+        if self.ttl and expiry - now < self.ttl // 2:
+            return info, 'refresh'
+        return info, None
+
     def get(self, key):
         ''' Return info of key from redis '''
         try:
-            info = self.rd.hgetall(key)
+            now = int(time.time())
+            info, action = self._read(key, self.rd.hget(self.bucket(key), self.field(key)), now)
+            if action == 'delete':
+                self.rd.hdel(self.bucket(key), self.field(key))
+            elif action == 'refresh':
+                pipe = self.rd.pipeline(transaction=False)
+                self._write(pipe, key, info, now)
+                pipe.execute()
             self.logger.info('Retrieved info of {} from redis.'.format(key))
             return info
         except Exception:
             self.logger.warning('Unable to get info of {} from redis.'.format(key), exc_info=True)
             return False
 
+    def get_many(self, keys):
+        '''
+        Return a dict of info of keys from redis in one round trip.
+        Info of keys not in redis is an empty dict.
+        '''
+        try:
+            now = int(time.time())
+            pipe = self.rd.pipeline(transaction=False)
+            for key in keys:
+                pipe.hget(self.bucket(key), self.field(key))
+            result = dict()
+            changed = False
+            for key, value in zip(keys, pipe.execute()):
+                info, action = self._read(key, value, now)
+                if action == 'delete':
+                    pipe.hdel(self.bucket(key), self.field(key))
+                elif action == 'refresh':
+                    self._write(pipe, key, info, now)
+                changed = changed or bool(action)
+                result[key] = info
+            if changed:
+                pipe.execute()
+            self.logger.info('Retrieved info of {} keys from redis.'.format(len(keys)))
+            return result
+        except Exception:
+            self.logger.warning('Unable to get info of {} keys from redis.'.format(len(keys)), exc_info=True)
+            return dict()
+
     def set(self, key, info):
         '''
         Set info of key
         info: a dictionary of metadata of key
         '''
         try:
-            self.rd.hmset(key, info)
+            pipe = self.rd.pipeline(transaction=False)
+            self._write(pipe, key, info)
+            pipe.execute()
             self.logger.info('Inserted info of {} to redis.'.format(key))
             return True
         except Exception:
@@ -292,9 +757,81 @@ class Redis(object):
     def delete(self, key):
         ''' Delete info of key '''
         try:
-            self.rd.delete(key)
+            self.rd.hdel(self.bucket(key), self.field(key))
             self.logger.info('Deleted info of {} from redis.'.format(key))
             return True
         except Exception:
             self.logger.warning('Unable to connect redis to delete info of {}'.format(key), exc_info=True)
             return False
+
+    def export(self):
+        '''
+        Yield (key, info) of all unexpired info in redis.
+        Keys stored hashed are yielded hashed, load() inserts them back as is.
+        '''
+        now = int(time.time())
+        for bucket in self.rd.scan_iter(match=self.prefix + '*', count=1000):
+            for key, value in self.rd.hgetall(bucket).items():
+                info, action = self._read(key, value, now)
+                if info:
+                    yield key, info
+
+    def load(self, items, batch=1000):
+        '''
+        Insert info of many keys.
+        Return number of keys inserted, even if insertion stopped on error.
+        items: iterable of (key, info)
+        '''
+        count = 0
+        queued = 0
+        try:
+            pipe = self.rd.pipeline(transaction=False)
+            for key, info in items:
+                self._write(pipe, key, info)
+                queued += 1
+                if queued == batch:
+                    pipe.execute()
+                    count += queued
+                    queued = 0
+            pipe.execute()
+            count += queued
+            self.logger.info('Inserted info of {} keys to redis.'.format(count))
+        except Exception:
+            self.logger.warning('Unable to insert info of keys to redis, {} inserted'.format(count),
+                                exc_info=True)
+        return count
+
+    def prune(self):
+        ''' Remove expired info from redis. Return number of keys removed. '''
+        count = 0
+        now = int(time.time())
+        for bucket in self.rd.scan_iter(match=self.prefix + '*', count=1000):
+            expired = [key for key, value in self.rd.hgetall(bucket).items()
+                       if self._read(key, value, now)[1] == 'delete']
+            if expired:
+                self.rd.hdel(bucket, *expired)
+                count += len(expired)
+        self.logger.info('Removed {} expired keys from redis.'.format(count))
+        return count
+
+    def prune_legacy(self):
+        '''
+        Move info stored by previous versions, one hash per file named
+        after its uri, to packed info, and delete those hashes.
+        They have no expiry and are not read anymore.
+        Return number of keys migrated.
+        '''
+        count = 0
+        for key in self.rd.scan_iter(match='*/*', count=1000):
+            if key.startswith(self.prefix) or \
+                    not FileSystem.is_upload_dir(key.split('/', 1)[0]) or \
+                    self.rd.type(key) != 'hash':
+                continue
+            info = self.rd.hgetall(key)
+            if 'content_length' in info and 'content_type' in info:
+                self.set(key, {'content_length': info['content_length'],
+                               'content_type': info['content_type']})
+            self.rd.delete(key)
+            count += 1
+        self.logger.info('Migrated {} legacy keys in redis.'.format(count))
+        return count
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+
+
+def rebalance(args):
+    ''' Move uploaded files to their placement dir '''
+    from curl2share.storage import FileSystem
+    moved = FileSystem().rebalance()
+    print('{} dirs moved.'.format(moved))
+
+
+def redis_export(args):
+    ''' Write info of files in redis as json lines '''
+    from curl2share.storage import Redis
+    out = open(args.file, 'w') if args.file else sys.stdout
+    try:
+        for path, info in Redis().export():
+            info['path'] = path
+            out.write(json.dumps(info) + '\n')
+    finally:
+        if args.file:
+            out.close()
+
+
+def redis_warmup(args):
+    ''' Insert info of files to redis from an export or from S3 '''
+    from curl2share.storage import Redis
+
+    def from_file(fname):
+        with open(fname) as f:
+            for line in f:
+                if line.strip():
+                    info = json.loads(line)
+                    yield info.pop('path'), info
+
+    def from_s3(batch=1000):
+        from curl2share.storage import S3
+        s3 = S3()
+        paths = []
+        for path in s3.list():
+            if not path.startswith('healthcheck/'):
+                paths.append(path)
+            if len(paths) == batch:
+                for item in from_paths(s3, paths):
+                    yield item
+                paths = []
+        for item in from_paths(s3, paths):
+            yield item
+
+    def from_paths(s3, paths):
+        # objects deleted since listed have no info
+        for path, info in s3.info_many(paths).items():
+            if info:
+                yield path, info
+
+    items = from_file(args.file) if args.file else from_s3()
+    count = Redis().load(items)
+    print('Info of {} files inserted.'.format(count))
+
+
+def redis_prune(args):
+    ''' Remove expired info from redis '''
+    from curl2share.storage import Redis
+    redis = Redis()
+    if args.legacy:
+        count = redis.prune_legacy()
+        print('Info of {} files migrated.'.format(count))
+    count = redis.prune()
+    print('Info of {} files removed.'.format(count))
+
+
+class ReadStream(object):
+    ''' Stream with read() only, like werkzeug LimitedStream '''
+    def __init__(self, data):
+        self.stream = io.BytesIO(data)
+
+    def read(self, size=-1):
+        return self.stream.read(size)
+
+
+def bench_write(args):
+    '''
+    Compare write paths of uploaded stream to disk, for streams
+    with read() only (werkzeug 0.11) and streams with readinto()
+    '''
+    import config
+    config.STORAGE = 'LOCAL'
+    tmpdir = tempfile.mkdtemp()
+    config.UPLOAD_DIRS = [tmpdir]
+    from curl2share.storage import FileSystem
+    fs = FileSystem()
+    size = args.size * 1024 * 1024
+    data = os.urandom(size)
+    dst = os.path.join(tmpdir, 'bench')
+    methods = [('chunks', lambda req: fs.write_chunks(dst, req)),
+               ('write_into', lambda req: fs.write_into(dst, req, size))]
+    streams = [('read', ReadStream), ('readinto', io.BytesIO)]
+    try:
+        for stream_name, stream in streams:
+            for name, write in methods:
+                elapsed = cpu = 0
+                for _ in range(args.number):
+                    req = stream(data)
+                    start, start_cpu = time.time(), sum(os.times()[:2])
+                    write(req)
+                    elapsed += time.time() - start
+                    cpu += sum(os.times()[:2]) - start_cpu
+                    os.remove(dst)
+                gb = size * args.number / 1024.0 ** 3
+                print('{:10} {:10} {:8.1f} MB/s {:8.2f} cpu s/GB'.format(
+                    stream_name, name, size * args.number / 1024.0 ** 2 / elapsed, cpu / gb))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    parser_rebalance = subparsers.add_parser(
+        'rebalance',
+        help='Move files after adding a dir to UPLOAD_DIRS')
+    parser_rebalance.set_defaults(func=rebalance)
+
+    parser_export = subparsers.add_parser(
+        'redis-export',
+        help='Export info of files in redis as json lines')
+    parser_export.add_argument('-f', '--file',
+                               help='Output file. Default: stdout')
+    parser_export.set_defaults(func=redis_export)
+
+    parser_warmup = subparsers.add_parser(
+        'redis-warmup',
+        help='Insert info of files to redis')
+    parser_warmup.add_argument('-f', '--file',
+                               help='File from redis-export. '
+                                    'Default: read info from S3')
+    parser_warmup.set_defaults(func=redis_warmup)
+
+    parser_prune = subparsers.add_parser(
+        'redis-prune',
+        help='Remove expired info from redis')
+    parser_prune.add_argument('--legacy', action='store_true',
+                              help='Also migrate and delete info stored one '
+                                   'hash per file by previous versions')
+    parser_prune.set_defaults(func=redis_prune)
+
+    parser_bench = subparsers.add_parser(
+        'bench-write',
+        help='Benchmark writing uploaded stream to disk')
+    parser_bench.add_argument('-s', '--size', type=int, default=100,
+                              help='File size in MB. Default: 100')
+    parser_bench.add_argument('-n', '--number', type=int, default=10,
+                              help='Number of writes. Default: 10')
+    parser_bench.set_defaults(func=bench_write)
+
+    args = parser.parse_args()
+    args.func(args)
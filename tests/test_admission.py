@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+import os
+import tempfile
+
+import unittest
+
+from curl2share.admission import Admission
+
+
+class AdmissionTests(unittest.TestCase):
+
+    def setUp(self):
+        self.admission = Admission()
+        self.admission.enabled = True
+        self.admission.state_file = os.path.join(tempfile.mkdtemp(), 'admission')
+        self.admission.worker_uploads = 2
+        self.admission.worker_bytes = 1000
+        self.admission.node_uploads = 2
+        self.admission.node_bytes = 1000
+        self.admission.rate = 100
+
+    def tearDown(self):
+        if os.path.exists(self.admission.state_file):
+            os.remove(self.admission.state_file)
+
+    def test_admit_release(self):
+        ''' Uploads within limits are admitted and released '''
+        self.assertIsNone(self.admission.acquire(400))
+        self.assertIsNone(self.admission.acquire(400))
+        state = self.admission.state()
+        self.assertEqual(state['WorkerUploads'], 2)
+        self.assertEqual(state['NodeBytes'], 800)
+        self.admission.release(400)
+        self.admission.release(400)
+        state = self.admission.state()
+        self.assertEqual(state['WorkerUploads'], 0)
+        self.assertEqual(state['NodeUploads'], 0)
+
+    def test_missing_settings(self):
+        ''' config.py without admission settings uses defaults '''
+        import config
+        saved = config.ADMISSION_NODE_SIZE
+        del config.ADMISSION_NODE_SIZE
+        try:
+            self.assertEqual(Admission().node_bytes, 40 * 1024 * 1024)
+        finally:
+            config.ADMISSION_NODE_SIZE = saved
+
+    def test_too_large(self):
+        ''' Upload over a limit on its own is never admitted '''
+        self.assertTrue(self.admission.too_large(1001))
+        self.assertFalse(self.admission.too_large(1000))
+
+    def test_reject_bytes(self):
+        ''' Retry-After is time to drain bytes over the limit '''
+        self.assertIsNone(self.admission.acquire(800))
+        self.assertEqual(self.admission.acquire(500), 3)
+        self.assertEqual(self.admission.state()['Rejected'], 1)
+
+    def test_reject_uploads(self):
+        ''' Too many uploads are rejected '''
+        self.admission.acquire(1)
+        self.admission.acquire(1)
+        self.assertTrue(self.admission.acquire(1) >= 1)
+
+    def test_reject_node(self):
+        ''' Uploads of other workers count to node limits '''
+        self.admission.worker_bytes = 10000
+        with open(self.admission.state_file, 'w') as f:
+            f.write('{"1": [1, 900]}')
+        self.assertTrue(self.admission.acquire(200))
+        self.assertIsNone(self.admission.acquire(100))
+
+
+if __name__ == '__main__':
+    unittest.main()
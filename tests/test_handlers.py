@@ -3,12 +3,15 @@
 
 from __future__ import absolute_import
 import os
+import json
 import tempfile
+from io import BytesIO
 
 import unittest
 import pytest
 
 from tests.context import app
+from curl2share.handlers import admission
 import config
 
 
@@ -130,5 +133,134 @@ class HandlerTests(unittest.TestCase):
         self.check_emptyfile(rvf)
         self.check_emptyfile(rvs)
 
+    def test_put_stream_write_into(self):
+        ''' Streamed upload is written through reused buffer '''
+        from curl2share.handlers import fs
+        calls = []
+        write_into = fs.write_into
+
+        def spy(dst, req, size=None):
+            calls.append(size)
+            return write_into(dst, req, size)
+
+        fs.write_into = spy
+        try:
+            rv = self.client.put('/test.txt', data='content',
+                                 environ_base={'REMOTE_ADDR': '10.0.0.4'})
+        finally:
+            del fs.write_into
+        self.check_success(rv, b'test.txt')
+        self.assertEqual(calls, [len('content')])
+
+    def test_upload_busy(self):
+        ''' Upload over admission limits is rejected before reading body '''
+        class Unreadable(BytesIO):
+            def read(self, *args):
+                raise AssertionError('body must not be read')
+            readline = readinto = read
+
+        saved = admission.worker_uploads
+        admission.worker_uploads = 0
+        try:
+            rv = self.client.put('/test.txt', input_stream=Unreadable(b'content'),
+                                 content_length=len('content'),
+                                 environ_base={'REMOTE_ADDR': '10.0.0.1'})
+        finally:
+            admission.worker_uploads = saved
+        self.assertEqual(rv.status_code, 503)
+        self.assertTrue(int(rv.headers['Retry-After']) >= 1)
+
+    def test_upload_too_large_for_admission(self):
+        ''' Upload too large to be admitted gets 413 instead of 503 '''
+        saved = admission.worker_bytes
+        admission.worker_bytes = 3
+        try:
+            rv = self.client.put('/test.txt', data='content',
+                                 environ_base={'REMOTE_ADDR': '10.0.0.2'})
+        finally:
+            admission.worker_bytes = saved
+        self.check_largefile(rv)
+
+    def test_upload_release(self):
+        ''' Admission is released when upload is aborted '''
+        uploads, inflight = admission.uploads, admission.bytes
+        # empty file is aborted with 411 after admission
+        rv = self.client.post('/', data={'file': (BytesIO(), 'empty.txt')},
+                              environ_base={'REMOTE_ADDR': '10.0.0.3'})
+        self.check_emptyfile(rv)
+        self.assertEqual((admission.uploads, admission.bytes), (uploads, inflight))
+
+    def test_bulk_info(self):
+        ''' Get info of many files in one request '''
+        rv = self.client.post('/test.txt', data='content')
+        path = rv.data.decode().strip().split('/', 3)[3]
+        rvi = self.client.post('/api/info',
+                               data=json.dumps({'paths': [path, 'nope/none.txt']}),
+                               content_type='application/json')
+        self.assertEqual(rvi.status_code, 200)
+        files = json.loads(rvi.data.decode())['Files']
+        self.assertEqual(files[0]['Path'], path)
+        self.assertEqual(files[0]['Size'], len('content'))
+        self.assertTrue(files[0]['Url'].endswith(path))
+        self.assertEqual(files[1]['Error'], 'Not Found')
+
+    def test_bulk_info_s3(self):
+        ''' Info missing in redis is got from S3 and inserted back '''
+        from curl2share import handlers
+        from curl2share.storage import Redis
+        from tests.test_storage import FakeRedis
+
+        class FakeS3(object):
+            def __init__(self):
+                self.requested = []
+
+            def info_many(self, paths, workers):
+                self.requested.extend(paths)
+                return dict((p, {'content_length': '20', 'content_type': 'image/png'}
+                             if p == 'b/2' else None) for p in paths)
+
+            def url(self, path):
+                return 'https://s3/' + path
+
+        redis = Redis()
+        redis.rd = FakeRedis()
+        redis.set('a/1', {'content_length': '10', 'content_type': 'text/plain'})
+        saved_config = (config.STORAGE, config.REDIS)
+        # with LOCAL storage, handlers has no s3 and Redis
+        missing = object()
+        saved = dict((name, getattr(handlers, name, missing)) for name in ('s3', 'Redis'))
+        config.STORAGE, config.REDIS = 'S3', True
+        s3 = FakeS3()
+        handlers.s3, handlers.Redis = s3, lambda: redis
+        try:
+            redis.rd.round_trips = 0
+            rv = self.client.post('/api/info',
+                                  data=json.dumps({'paths': ['a/1', 'b/2', 'c/3']}),
+                                  content_type='application/json')
+        finally:
+            config.STORAGE, config.REDIS = saved_config
+            for name, value in saved.items():
+                if value is missing:
+                    delattr(handlers, name)
+                else:
+                    setattr(handlers, name, value)
+        files = json.loads(rv.data.decode())['Files']
+        self.assertEqual(files[0], {'Path': 'a/1', 'Size': 10, 'Type': 'text/plain',
+                                    'Url': 'https://s3/a/1'})
+        self.assertEqual(files[1]['Size'], 20)
+        self.assertEqual(files[2]['Error'], 'Not Found')
+        # only misses are requested to S3, found ones are inserted to redis:
+        # one round trip to read, one to write back
+        self.assertEqual(sorted(s3.requested), ['b/2', 'c/3'])
+        self.assertEqual(redis.rd.round_trips, 2)
+        self.assertEqual(redis.get('b/2'), {'content_length': '20', 'content_type': 'image/png'})
+        self.assertEqual(redis.get('c/3'), {})
+
+    def test_bulk_info_invalid(self):
+        ''' Reject request without a list of paths '''
+        rv = self.client.post('/api/info', data=json.dumps({'paths': 'x'}),
+                              content_type='application/json')
+        self.assertEqual(rv.status_code, 400)
+
 if __name__ == '__main__':
     unittest.main()
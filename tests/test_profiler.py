@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+import os
+import shutil
+import tempfile
+
+import unittest
+from flask import Flask
+
+from tests.context import config
+from curl2share.profiler import Profiler
+
+
+class ProfilerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = dict((k, getattr(config, k, None)) for k in
+                          ('PROFILE', 'PROFILE_TOKEN', 'PROFILE_SAMPLE',
+                           'PROFILE_DIR', 'PROFILE_KEEP'))
+        self.tmpdir = tempfile.mkdtemp()
+        config.PROFILE = True
+        config.PROFILE_TOKEN = 'secret'
+        config.PROFILE_SAMPLE = 0
+        config.PROFILE_DIR = self.tmpdir
+        config.PROFILE_KEEP = 2
+        self.app = Flask(__name__)
+
+        @self.app.route('/ping')
+        def ping():
+            return 'pong'
+
+        self.profiler = Profiler(self.app)
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        for k, v in self.saved.items():
+            setattr(config, k, v)
+        shutil.rmtree(self.tmpdir)
+
+    def test_header(self):
+        ''' Only requests with valid token are profiled '''
+        self.client.get('/ping')
+        self.client.get('/ping', headers={'X-Profile': 'wrong'})
+        self.assertEqual(os.listdir(self.tmpdir), [])
+        self.client.get('/ping', headers={'X-Profile': 'secret'})
+        dumps = os.listdir(self.tmpdir)
+        self.assertEqual(len(dumps), 1)
+        self.assertTrue('-GET-ping-200-' in dumps[0])
+
+    def test_sample_keep(self):
+        ''' 1 in N requests are profiled and latest dumps are kept '''
+        self.profiler.sample = 2
+        for _ in range(8):
+            self.client.get('/ping')
+        self.assertEqual(len(os.listdir(self.tmpdir)), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+import io
+import os
+import fnmatch
+import logging
+import time
+import shutil
+import tempfile
+import unittest
+
+import botocore
+import config
+from curl2share.storage import HashRing, Redis, FileSystem, S3
+
+
+class HashRingTests(unittest.TestCase):
+
+    def setUp(self):
+        self.keys = ['key{}'.format(i) for i in range(1000)]
+        self.ring = HashRing(['/disk1', '/disk2', '/disk3'])
+
+    def test_deterministic(self):
+        ''' Same key is always placed on same node '''
+        other = HashRing(['/disk3', '/disk1', '/disk2'])
+        for key in self.keys:
+            self.assertEqual(self.ring.get(key), other.get(key))
+
+    def test_spread(self):
+        ''' All nodes get keys '''
+        placed = set(self.ring.get(key) for key in self.keys)
+        self.assertEqual(placed, set(['/disk1', '/disk2', '/disk3']))
+
+    def test_add_node(self):
+        ''' Adding node only moves keys to the new node '''
+        before = dict((key, self.ring.get(key)) for key in self.keys)
+        self.ring.add('/disk4')
+        for key in self.keys:
+            after = self.ring.get(key)
+            if after != before[key]:
+                self.assertEqual(after, '/disk4')
+
+    def test_nodes(self):
+        ''' nodes() returns owner first and every node once '''
+        for key in self.keys[:50]:
+            nodes = self.ring.nodes(key)
+            self.assertEqual(nodes[0], self.ring.get(key))
+            self.assertEqual(sorted(nodes), ['/disk1', '/disk2', '/disk3'])
+
+
+class FakeRedis(object):
+    ''' In memory redis hashes, counting round trips '''
+    def __init__(self, fail_after=None):
+        self.hashes = dict()
+        self.round_trips = 0
+        self.fail_after = fail_after
+
+    def hget(self, name, key):
+        return self.hashes.get(name, {}).get(key)
+
+    def hset(self, name, key, value):
+        self.hashes.setdefault(name, {})[key] = value
+
+    def hdel(self, name, *keys):
+        for key in keys:
+            self.hashes.get(name, {}).pop(key, None)
+
+    def expire(self, name, ttl):
+        pass
+
+    def hgetall(self, name):
+        return dict(self.hashes.get(name, {}))
+
+    def type(self, name):
+        return 'hash' if name in self.hashes else 'none'
+
+    def delete(self, name):
+        self.hashes.pop(name, None)
+
+    def scan_iter(self, match='*', count=None):
+        return [name for name in list(self.hashes) if fnmatch.fnmatch(name, match)]
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+class FakePipeline(object):
+    ''' Queue commands of FakeRedis until execute() '''
+    def __init__(self, rd):
+        self.rd = rd
+        self.queue = []
+
+    def __getattr__(self, name):
+        return lambda *args: self.queue.append((name, args))
+
+    def execute(self):
+        if self.rd.fail_after is not None and self.rd.round_trips >= self.rd.fail_after:
+            raise IOError('connection lost')
+        self.rd.round_trips += 1
+        queue, self.queue = self.queue, []
+        return [getattr(self.rd, name)(*args) for name, args in queue]
+
+
+class RedisTests(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = Redis()
+        self.redis.ttl = 100
+        self.info = {'content_length': '1024', 'content_type': 'text/plain'}
+
+    def test_pack(self):
+        ''' Info is packed with its expiry time '''
+        value = self.redis.pack(self.info, now=1000)
+        self.assertEqual(value, '1100|1024|1')
+        self.assertEqual(self.redis.unpack(value), (1100, self.info))
+        self.info['content_type'] = 'application/x-unknown'
+        value = self.redis.pack(self.info, now=1000)
+        self.assertEqual(value, '1100|1024|application/x-unknown')
+        self.assertEqual(self.redis.unpack(value), (1100, self.info))
+
+    def test_field(self):
+        ''' Long keys are stored hashed to keep hashes compact '''
+        self.assertEqual(self.redis.field('Ab3dE6/test.txt'), 'Ab3dE6/test.txt')
+        field = self.redis.field('Ab3dE6/' + 'x' * 100)
+        self.assertTrue(field.startswith('#'))
+        self.assertTrue(len(field) <= self.redis.max_field)
+        self.assertEqual(self.redis.field(field), field)
+        docx = {'content_length': '1024',
+                'content_type': 'application/vnd.openxmlformats-'
+                                'officedocument.wordprocessingml.document'}
+        self.assertTrue(len(self.redis.pack(docx)) <= 64)
+
+    def test_load(self):
+        ''' Keys inserted before an error are counted '''
+        self.redis.rd = FakeRedis(fail_after=2)
+        items = (('key{}'.format(i), self.info) for i in range(25))
+        self.assertEqual(self.redis.load(items, batch=10), 20)
+        self.assertEqual(self.redis.get('key5'), self.info)
+
+    def test_prune_legacy(self):
+        ''' Hashes of previous versions are moved to packed info '''
+        self.redis.rd = FakeRedis()
+        self.redis.rd.hashes['Ab3dE6/test.txt'] = dict(self.info)
+        self.redis.rd.hashes['other/key'] = {'x': '1'}
+        self.assertEqual(self.redis.prune_legacy(), 1)
+        self.assertNotIn('Ab3dE6/test.txt', self.redis.rd.hashes)
+        self.assertIn('other/key', self.redis.rd.hashes)
+        self.assertEqual(self.redis.get('Ab3dE6/test.txt'), self.info)
+
+    def test_get_many(self):
+        ''' Info of many keys is read in one round trip '''
+        self.redis.rd = FakeRedis()
+        self.redis.load([('a/1', self.info), ('b/2', self.info)])
+        self.redis.rd.round_trips = 0
+        infos = self.redis.get_many(['a/1', 'b/2', 'c/3'])
+        self.assertEqual(infos, {'a/1': self.info, 'b/2': self.info, 'c/3': {}})
+        self.assertEqual(self.redis.rd.round_trips, 1)
+
+    def test_bucket(self):
+        ''' Key is always stored in same bucket '''
+        bucket = self.redis.bucket('Ab3dE6/test.txt')
+        self.assertTrue(bucket.startswith(self.redis.prefix))
+        self.assertEqual(bucket, self.redis.bucket('Ab3dE6/test.txt'))
+
+    def test_read(self):
+        ''' Expired info is removed, info near expiry is refreshed '''
+        now = int(time.time())
+        value = self.redis.pack(self.info, now)
+        self.assertEqual(self.redis._read('k', value, now), (self.info, None))
+        self.assertEqual(self.redis._read('k', value, now + 60), (self.info, 'refresh'))
+        self.assertEqual(self.redis._read('k', value, now + 100), ({}, 'delete'))
+        self.assertEqual(self.redis._read('k', None, now), ({}, None))
+
+
+class FakeS3Client(object):
+    ''' Answer HEAD requests of objects in a dict '''
+    def __init__(self, objects):
+        self.objects = objects
+
+    def head_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise botocore.exceptions.ClientError({'Error': {'Code': '404'}}, 'HeadObject')
+        return {'ResponseMetadata': {'HTTPHeaders': self.objects[Key]}}
+
+
+class S3Tests(unittest.TestCase):
+
+    def test_info_many(self):
+        ''' Info of many objects, None for objects not found '''
+        s3 = S3.__new__(S3)
+        s3.bucket = 'curl2share'
+        s3.logger = logging.getLogger(__name__)
+        s3.client = FakeS3Client({
+            'a/1': {'content-length': '10', 'content-type': 'text/plain'},
+            'b/2': {'content-length': '20', 'content-type': 'image/png'}})
+        infos = s3.info_many(['a/1', 'b/2', 'c/3'], workers=3)
+        self.assertEqual(infos['a/1'], {'content_length': '10', 'content_type': 'text/plain'})
+        self.assertEqual(infos['b/2'], {'content_length': '20', 'content_type': 'image/png'})
+        self.assertIsNone(infos['c/3'])
+        self.assertEqual(s3.info_many([]), {})
+
+
+class ReadOnlyStream(object):
+    ''' Stream without readinto(), like werkzeug LimitedStream '''
+    def __init__(self, data, fail=False):
+        self.stream = io.BytesIO(data)
+        self.fail = fail
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        if self.fail and self.stream.tell() > 0:
+            raise IOError('client disconnected')
+        return data
+
+
+class FormFile(object):
+    ''' File sent by multipart/form-data '''
+    def __init__(self, data):
+        self.stream = io.BytesIO(data)
+
+    def save(self, dst, buffer_size=16384):
+        shutil.copyfileobj(self.stream, dst, buffer_size)
+
+
+class FileSystemTests(unittest.TestCase):
+
+    def setUp(self):
+        self.fs = FileSystem()
+        self.fs.buf_size = 1000
+        self.tmpdir = tempfile.mkdtemp()
+        self.dst = os.path.join(self.tmpdir, 'test.bin')
+        self.data = os.urandom(12345)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def read(self):
+        with open(self.dst, 'rb') as f:
+            return f.read()
+
+    def test_rebalance(self):
+        ''' Only upload dirs are moved to their placement dir '''
+        dirs = [os.path.join(self.tmpdir, d) for d in ('disk1', 'disk2')]
+        for d in dirs:
+            os.mkdir(d)
+        os.mkdir(os.path.join(dirs[0], 'lost+found'))
+        sdirs = ['{:06d}'.format(i)[-config.RAND_DIR_LENGTH:] for i in range(20)]
+        for sdir in sdirs:
+            os.mkdir(os.path.join(dirs[0], sdir))
+            with open(os.path.join(dirs[0], sdir, 'f.txt'), 'w') as f:
+                f.write(sdir)
+        self.fs.store_dirs = dirs
+        self.fs.ring = HashRing(dirs)
+        self.assertTrue(self.fs.rebalance() > 0)
+        self.assertEqual(os.listdir(dirs[1]).count('lost+found'), 0)
+        self.assertTrue(os.path.isdir(os.path.join(dirs[0], 'lost+found')))
+        for sdir in sdirs:
+            path = sdir + '/f.txt'
+            self.assertEqual(self.fs.locate(path), self.fs.volume(path))
+            with open(self.fs.path(path)) as f:
+                self.assertEqual(f.read(), sdir)
+        for d in dirs:
+            self.assertFalse([n for n in os.listdir(d) if n.endswith('.tmp')])
+
+    def test_write_chunks(self):
+        ''' Stream is written by chunks '''
+        self.assertEqual(self.fs.write_chunks(self.dst, io.BytesIO(self.data)), len(self.data))
+        self.assertEqual(self.read(), self.data)
+
+    def test_write_into(self):
+        ''' Stream is written through reused buffer '''
+        written = self.fs.write_into(self.dst, io.BytesIO(self.data), len(self.data))
+        self.assertEqual(written, len(self.data))
+        self.assertEqual(self.read(), self.data)
+
+    def test_write_into_read_only(self):
+        ''' Stream without readinto() is written through reused buffer '''
+        written = self.fs.write_into(self.dst, ReadOnlyStream(self.data), len(self.data))
+        self.assertEqual(written, len(self.data))
+        self.assertEqual(self.read(), self.data)
+
+    def test_write_into_disconnect(self):
+        ''' Preallocated file is removed if stream breaks '''
+        self.assertRaises(IOError, self.fs.write_into, self.dst,
+                          ReadOnlyStream(self.data, fail=True), len(self.data))
+        self.assertFalse(os.path.exists(self.dst))
+
+    def test_fadvise_needs_fsync(self):
+        ''' Page cache hint is only sent once pages are synced '''
+        if not hasattr(os, 'posix_fadvise'):
+            return
+        hints = []
+        fadvise = os.posix_fadvise
+        os.posix_fadvise = lambda *args: hints.append(args)
+        self.fs.fadvise = True
+        try:
+            self.fs.fsync = 'none'
+            self.fs.write_into(self.dst, io.BytesIO(self.data), len(self.data))
+            self.assertEqual(hints, [])
+            self.fs.fsync = 'fdatasync'
+            self.fs.write_into(self.dst, io.BytesIO(self.data), len(self.data))
+            self.assertEqual(len(hints), 1)
+        finally:
+            os.posix_fadvise = fadvise
+
+    def test_write_form(self):
+        ''' Fsync policy is applied to multipart/form-data files '''
+        finished = []
+        self.fs._finish = finished.append
+        written = self.fs.write_form(self.dst, FormFile(self.data), len(self.data))
+        self.assertEqual(written, len(self.data))
+        self.assertEqual(self.read(), self.data)
+        self.assertEqual(len(finished), 1)
+
+    def test_write_into_short(self):
+        ''' Space preallocated but not written is dropped '''
+        self.fs.write_into(self.dst, io.BytesIO(self.data), len(self.data) * 2)
+        self.assertEqual(self.read(), self.data)
+
+
+if __name__ == '__main__':
+    unittest.main()